@@ -1,68 +1,103 @@
-import codecs
 import re
 import os
+from functools import partial
+from itertools import islice
 from posixpath import normpath
 
 from .utils import (
     PyDecanterParser,
-    get_cache_filepath,
     get_basename,
     get_filename,
     add_cache_tag,
+    map_threaded,
+    write_minified,
 )
 from rcssmin import cssmin
 
 
+RE_SLASHES = re.compile(r"/{2,}")
+
+
+def join_url(directory, url):
+    """joins a relative url onto a directory (which must be normalized and end
+    with a slash), only resorting to normpath when the url has '.', '..' or
+    empty segments that need resolving."""
+    if "./" in url or "//" in url or url.endswith((".", "/")):
+        return normpath(directory + url)
+    return directory + url
+
+
 class CssAbsoluteFilter(object):
 
-    RE_URL = re.compile(r"url\(([^\)]+)\)")
-    RE_SRC = re.compile(r'src=([\'"])(.+?)\1')
+    # matches either url(...) or src='...' references, so that content only
+    #  needs to be scanned once.
+    RE_URL_OR_SRC = re.compile(r"url\(([^\)]+)\)|src=(['\"])(.+?)\2")
+
+    # urls which don't need rewriting (left exactly as they are in the source)
+    SKIP_PREFIXES = ("data:", "http://", "https://", "//", "#")
 
     def __init__(self, base_root, base_url):
 
         self.base_root = base_root
         self.base_url = base_url.rstrip("/")
-        self.directory_name = None
+
+        # resolved (cache-tagged) urls, so that assets referenced repeatedly
+        #  are only looked up and hashed once per filter.
+        self._url_cache = {}
 
     def process(self, content, filename=None, basename=None):
 
         if filename is None:
             return content
 
-        filename = os.path.normcase(os.path.abspath(filename))
-
+        # (the directory name is passed through to the converter, rather than
+        #  stored on the instance, so that files can be processed in parallel).
         path = basename.lstrip("/")
-        self.directory_name = "/".join((self.base_url, os.path.dirname(path)))
+        directory_name = normpath("/".join((self.base_url, os.path.dirname(path))))
+        directory_name = directory_name.rstrip("/") + "/"
 
-        return self.RE_SRC.sub(
-            self.src_converter, self.RE_URL.sub(self.url_converter, content)
+        return self.RE_URL_OR_SRC.sub(
+            partial(self.converter, directory_name=directory_name), content
         )
 
-    def _converter(self, match_obj, group, template):
+    def _converter(self, match_obj, group, template, directory_name):
         url = match_obj.group(group)
         url = url.strip(" '\"")
-        if url.startswith("#"):
-            return "url('{0}')".format(url)
-        elif url.startswith("data:"):
-            return "url('{0}')".format(url)
+        if url.startswith(self.SKIP_PREFIXES):
+            return match_obj.group(0)
         elif url.startswith("/"):
-            return "url('{0}')".format(
-                add_cache_tag(url, self.base_url, self.base_root)
+            return "url('{0}')".format(self._add_cache_tag(url))
+        full_url = join_url(directory_name, url)
+        return template.format(self._add_cache_tag(full_url))
+
+    def _add_cache_tag(self, url):
+        try:
+            return self._url_cache[url]
+        except KeyError:
+            tagged = self._url_cache[url] = add_cache_tag(
+                url, self.base_url, self.base_root
             )
-        full_url = normpath("/".join([str(self.directory_name), url]))
-        return template.format(add_cache_tag(full_url, self.base_url, self.base_root))
+            return tagged
 
-    def url_converter(self, match_obj):
-        return self._converter(match_obj, 1, "url('{0}')")
+    def converter(self, match_obj, directory_name):
+        if match_obj.group(1) is not None:
+            return self._converter(match_obj, 1, "url('{0}')", directory_name)
+        return self._converter(match_obj, 3, "src='{0}'", directory_name)
 
-    def src_converter(self, match_obj):
-        return self._converter(match_obj, 2, "src='{0}'")
+
+def load_and_filter(css_abs_filter, hunk):
+    hunk_type, value, basename, elem_ = hunk
+    if hunk_type == "file":
+        with open(value, encoding="utf8", newline="") as filehandle:
+            value = filehandle.read()
+
+    return css_abs_filter.process(value, basename, basename)
 
 
 def compress_css(css_block, context):
 
     # ensure our base_url ends in a (single) forward stroke
-    base_url = re.sub(r"//", "/", "/" + context["base_url"].strip("/") + "/")
+    base_url = RE_SLASHES.sub("/", "/" + context["base_url"].strip("/") + "/")
     base_root = context["base_root"]
     output_root = context["output_root"]
     assets_dir = os.path.join(output_root, context["assets_dir"])
@@ -76,17 +111,17 @@ def compress_css(css_block, context):
     node = []
     for elem in parser.elems:
         data = None
-        if elem["tag"] == "link" and elem["attrs_dict"]["rel"].lower() == "stylesheet":
+        if elem.tag == "link" and elem.attrs_dict["rel"].lower() == "stylesheet":
 
-            basename = get_basename(elem["attrs_dict"]["href"], base_url)
+            basename = get_basename(elem.attrs_dict["href"], base_url)
             filename = get_filename(basename, context["base_root"])
             data = ("file", filename, basename, elem)
-        elif elem["tag"] == "style":
-            data = ("inline", elem["text"], None, elem)
+        elif elem.tag == "style":
+            data = ("inline", elem.text, None, elem)
 
         if data:
             node.append(data)
-            media = elem["attrs_dict"].get("media", None)
+            media = elem.attrs_dict.get("media", None)
             # Append to the previous node if it had the same media type
             if media_nodes and media_nodes[-1][0] == media:
                 media_nodes[-1][1].append(data)
@@ -96,29 +131,25 @@ def compress_css(css_block, context):
     # now for each block of contiguous stylesheets with the same media type,
     #  we grab the contents, run it through the CssAbsoluteFilter (this, of
     #  course, has to be done per file, since the assets referenced by each
-    #  stylesheet will probably be using relative urls).
+    #  stylesheet will probably be using relative urls).  The files are
+    #  independent of one another, so they're loaded and filtered in parallel.
     css_abs_filter = CssAbsoluteFilter(base_root, base_url)
+    filtered = iter(
+        map_threaded(
+            partial(load_and_filter, css_abs_filter),
+            [hunk for media_type_, node in media_nodes for hunk in node],
+        )
+    )
     output_elems = []
     for media_type, node in media_nodes:
-        content = []
-        for hunk_type, value, basename, elem in node:
-            if hunk_type == "file":
-                with codecs.open(value, "rb", "utf8") as filehandle:
-                    value = filehandle.read()
-
-            content.append(css_abs_filter.process(value, basename, basename))
-
-        # now join the content and run it through cssmin
-        content = cssmin("".join(content))
+        content = "".join(islice(filtered, len(node)))
 
-        # create the output file, write the compressed content, and add it to
-        #  the list for outputting.
-        outputpath = get_cache_filepath(content, assets_dir, "css")
-        if not os.path.exists(outputpath):
-            with codecs.open(outputpath, "w", "utf8") as file_handle:
-                file_handle.write(content)
+        # now run the content through cssmin (unless it's been seen before),
+        #  write the compressed content to the output file, and add it to the
+        #  list for outputting.
+        outputpath = write_minified(content, assets_dir, "css", cssmin)
 
-        url = re.sub(r"//", "/", outputpath.replace(output_root, base_url))
+        url = RE_SLASHES.sub("/", outputpath.replace(output_root, base_url))
         output_elems.append((url, media_type))
 
     return "\n".join(
@@ -1,33 +1,31 @@
-import codecs
 import re
 import os
-from posixpath import normpath
 
-from slimit import minify
+from rjsmin import jsmin
 
 from .utils import PyDecanterParser, \
-    get_cache_filepath, get_basename, get_filename, add_cache_tag
-
-# monkeypatch to solve problem with ply=3.4
-#  (latest ply=3.6 solves this problem, but creates more)
-from ply import yacc
-def __getitem__(self,n):
-    if isinstance(n, slice):
-        return self.__getslice__(n.start, n.stop)
-    if n >= 0: return self.slice[n].value
-    else: return self.stack[n].value
-
-yacc.YaccProduction.__getitem__ = __getitem__
+    get_basename, get_filename, map_threaded, write_minified
 
+RE_SLASHES = re.compile(r'/{2,}')
+RE_USE_STRICT = re.compile(r'[\'"]?use strict[\'"]?;?')
 
 
 def do_replacements(text):
 
-    text = re.sub(r'[\'"]?use strict[\'"]?;?', '', text)
+    text = RE_USE_STRICT.sub('', text)
 
     return text
 
 
+def load_and_replace(node):
+    hunk_type, value, basename, elem = node
+    if hunk_type == 'file':
+        with open(value) as _fh:
+            value = _fh.read()
+
+    return do_replacements(value)
+
+
 def compress_js(js_block, context):
 
     # ensure our base_url ends in a (single) forward stroke
@@ -40,36 +38,22 @@ def compress_js(js_block, context):
 
     nodes = []
     for elem in parser.elems:
-        if 'src' in elem['attrs_dict']:
-            basename = get_basename(elem['attrs_dict']['src'], base_url)
+        if 'src' in elem.attrs_dict:
+            basename = get_basename(elem.attrs_dict['src'], base_url)
             filename = get_filename(basename, context['base_root'])
             nodes.append(('file', filename, basename, elem))
         else:
-            nodes.append(('inline', elem['text'], None, elem))
-
-    content = []
-    for hunk_type, value, basename, elem in nodes:
-        if hunk_type == 'file':
-            with open(value) as _fh:
-                value = _fh.read()
-
-        value = do_replacements(value)
-        content.append(value)
-
-    content = ''.join(content)
+            nodes.append(('inline', elem.text, None, elem))
 
-    content = minify(content, mangle=True, mangle_toplevel=False)
+    content = ''.join(map_threaded(load_and_replace, nodes))
 
     # APPLY FILTERS
 
-    # create the output file, write the compressed content, and return the
-    #  prepared tag
+    # minify the content (unless it's been seen before), create the output
+    #  file, write the compressed content, and return the prepared tag
 
-    outputpath = get_cache_filepath(content, assets_dir, 'js')
-    if not os.path.exists(outputpath):
-        with codecs.open(outputpath, 'w', 'utf8') as file_handle:
-            file_handle.write(content)
+    outputpath = write_minified(content, assets_dir, 'js', jsmin)
 
-    url = re.sub(r'//', '/', outputpath.replace(output_root, base_url))
+    url = RE_SLASHES.sub('/', outputpath.replace(output_root, base_url))
 
     return '<script src="{0}"></script>'.format(url)
@@ -19,9 +19,15 @@ Usage example:
     #  individually (e.g. os.path.walk)
     monitor.track('./')
 
+If the watchdog package is available, changes are picked up from the
+operating system's file system events (inotify, FSEvents, etc.); otherwise
+the monitor falls back to polling modification times every `interval`
+seconds.
+
 """
 
 import os
+import stat
 import sys
 import threading
 import atexit
@@ -29,6 +35,28 @@ try:
     import queue            # python 3.x
 except ImportError:
      import Queue as queue  # python 2.x
+try:
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+
+class _EventQueuer(object):
+    """ watchdog event handler which puts the paths of changed files on a
+    queue (to be picked up by the monitor thread). """
+
+    EVENT_TYPES = ('created', 'deleted', 'modified', 'moved')
+
+    def __init__(self, event_queue):
+        self._queue = event_queue
+
+    def dispatch(self, event):
+        if event.is_directory or event.event_type not in self.EVENT_TYPES:
+            return
+        self._queue.put(event.src_path)
+        if getattr(event, 'dest_path', None):
+            self._queue.put(event.dest_path)
+
 
 class Monitor(object):
 
@@ -36,55 +64,98 @@ class Monitor(object):
 
         self._times = {}
         self._files = []
+        self._files_set = set()
+        self._module_paths = {}
 
         self._queue = queue.Queue()
-        self._lock = threading.Lock()
         self._interval = interval
 
         self._thread = threading.Thread(target=self._monitor)
-        self._thread.setDaemon(True)
-
-        self._lock.acquire()
-
+        self._thread.daemon = True
         self._thread.start()
-        self._lock.release()
 
         atexit.register(self._exiting)
 
     def _on_modified(self, path):
+        # Note that monitoring stops once a change has been reported (the
+        # callback is expected to restart the process).
         self._queue.put(True)
         self.on_modified(path)
 
     def _modified(self, path):
+        # A single stat() both checks that the path denotes a file and
+        # gets its modification time (this runs for every file, every tick).
         try:
-            # If path doesn't denote a file and we were previously
-            # tracking it, then it has been removed or the file type
-            # has changed so force a restart. If not previously
-            # tracking the file then we can ignore it as probably
-            # pseudo reference such as when file extracted from a
-            # collection of modules contained in a zip file.
-            if not os.path.isfile(path):
-                return path in self._times
-
-            # Check for when file last modified.
-            mtime = os.stat(path).st_mtime
-            if path not in self._times:
-                self._times[path] = mtime
-
-            # Force restart when modification time has changed, even
-            # if time now older, as that could indicate older file
-            # has been restored.
-            if mtime != self._times[path]:
-                return True
-        except:
-            raise
-            # If any exception occured, likely that file has been
-            # been removed just before stat(), so force a restart.
+            path_stat = os.stat(path)
+        except OSError:
+            path_stat = None
+
+        # If path doesn't denote a file and we were previously
+        # tracking it, then it has been removed or the file type
+        # has changed so force a restart. If not previously
+        # tracking the file then we can ignore it as probably
+        # pseudo reference such as when file extracted from a
+        # collection of modules contained in a zip file.
+        if path_stat is None or not stat.S_ISREG(path_stat.st_mode):
+            return path in self._times
+
+        # Check for when file last modified.
+        mtime = path_stat.st_mtime
+        if path not in self._times:
+            self._times[path] = mtime
+
+        # Force restart when modification time has changed, even
+        # if time now older, as that could indicate older file
+        # has been restored.
+        if mtime != self._times[path]:
             return True
 
         return False
 
     def _monitor(self):
+        if Observer is None:
+            return self._poll()
+        return self._watch()
+
+    def _watch(self):
+        observer = Observer()
+        observer.daemon = True
+        observer.start()
+        handler = _EventQueuer(self._queue)
+        watched = set()
+        try:
+            while 1:
+                # Modules may be imported, and files tracked, after the
+                # monitor has started, so the set of paths is rebuilt (and
+                # any new directories watched) on each pass.
+                paths = self._paths()
+                for directory in set(map(os.path.dirname, paths)) - watched:
+                    watched.add(directory)
+                    try:
+                        observer.schedule(handler, directory)
+                    except OSError:
+                        pass
+
+                try:
+                    path = self._queue.get(timeout=self._interval)
+                except queue.Empty:
+                    continue
+                if path is True:
+                    return
+                if path in paths:
+                    return self._on_modified(path)
+        finally:
+            observer.stop()
+
+    def _paths(self):
+        paths = set(os.path.abspath(path) for path in self._files)
+        for module in list(sys.modules.values()):
+            path = getattr(module, '__file__', None)
+            if path:
+                paths.add(os.path.abspath(self._module_path(path)))
+        return paths
+
+    def _poll(self):
         while 1:
             # Check modification times on all files in sys.modules.
             for module in list(sys.modules.values()):
@@ -93,8 +164,7 @@ class Monitor(object):
                 path = getattr(module, '__file__')
                 if not path:
                     continue
-                if os.path.splitext(path)[1] in ('.pyc', '.pyo', '.pyd'):
-                    path = path[:-1]
+                path = self._module_path(path)
                 if self._modified(path):
                     return self._on_modified(path)
 
@@ -110,6 +180,18 @@ class Monitor(object):
             except:
                 pass
 
+    def _module_path(self, path):
+        # map compiled module files to their sources (memoized, as this is
+        # called for every module on every tick).
+        try:
+            return self._module_paths[path]
+        except KeyError:
+            source_path = path
+            if os.path.splitext(path)[1] in ('.pyc', '.pyo', '.pyd'):
+                source_path = path[:-1]
+            self._module_paths[path] = source_path
+            return source_path
+
     def _exiting(self):
         try:
             self._queue.put(True)
@@ -118,7 +200,8 @@ class Monitor(object):
         self._thread.join()
 
     def track(self, path):
-        if not path in self._files:
+        if path not in self._files_set:
+            self._files_set.add(path)
             self._files.append(path)
 
     def on_modified(self):
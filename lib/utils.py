@@ -1,65 +1,215 @@
 import datetime
 import hashlib
+import json
 import os
 import re
+import threading
 
-from html.parser import HTMLParser
+from concurrent.futures import ThreadPoolExecutor
+from html import unescape
 
 ##########################################################################
 # classes and functions to support the js and css compression decorators.
 ##########################################################################
 
 
-class PyDecanterParser(HTMLParser):
+class ParsedElem(object):
+    """ a tag (with its attributes and text) found by PyDecanterParser """
+
+    __slots__ = ("tag", "attrs_dict", "text")
+
+    def __init__(self, tag, attrs_dict, text):
+        self.tag = tag
+        self.attrs_dict = attrs_dict
+        self.text = text
+
+
+# elems parsed from previously seen blocks, keyed by (content, tags) -- the
+#  same blocks tend to be rendered over and over (by every page of a site).
+_PARSE_CACHE = {}
+PARSE_CACHE_SIZE = 256
+
+
+class PyDecanterParser(object):
+    """extracts the requested tags (along with their attributes and any text
+    content) from a block of html -- the blocks we deal with are generated
+    from templates and are small and well-formed, so regular expressions are
+    sufficient and far quicker than a full HTMLParser."""
+
+    # comments are matched so that any tags inside them are skipped.
+    RE_TAG = re.compile(
+        r"<!--[\s\S]*?-->|<([a-zA-Z][-a-zA-Z0-9]*)((?:[^>\"']|\"[^\"]*\"|'[^']*')*)>"
+    )
+    RE_ATTR = re.compile(
+        r"([^\s\"'>/=]+)(?:\s*=\s*(?:\"([^\"]*)\"|'([^']*)'|([^\s\"'>]+)))?"
+    )
+    # the content of these elements is raw text, and runs to the closing tag.
+    RE_RAW_TEXT_END = {
+        "script": re.compile(r"</script\s*>", re.IGNORECASE),
+        "style": re.compile(r"</style\s*>", re.IGNORECASE),
+    }
+
     def __init__(self, content, tags):
-        HTMLParser.__init__(self, convert_charrefs=True)
         self.content = content
         self.tags = tags
-        self.elems = []
-        self._current_tag = None
-        self.feed(self.content)
-        self.close()
-
-    def handle_starttag(self, tag, attrs):
-        tag = tag.lower()
-        if tag in self.tags:
-            self.elems.append(
-                {"tag": tag, "attrs": attrs, "attrs_dict": dict(attrs), "text": None}
-            )
-            self._current_tag = tag
 
-    def handle_endtag(self, tag):
-        if self._current_tag and self._current_tag == tag.lower():
-            self._current_tag = None
-
-    def handle_data(self, data):
-        if self._current_tag in self.tags:
-            self.elems[-1]["text"] = data
+        key = (content, tuple(tags))
+        self.elems = _PARSE_CACHE.get(key)
+        if self.elems is None:
+            self.elems = []
+            self.parse()
+            if len(_PARSE_CACHE) >= PARSE_CACHE_SIZE:
+                _PARSE_CACHE.pop(next(iter(_PARSE_CACHE)), None)
+            _PARSE_CACHE[key] = self.elems
+
+    def parse(self):
+        content = self.content
+        pos = 0
+        while True:
+            match = self.RE_TAG.search(content, pos)
+            if match is None:
+                break
+            pos = match.end()
+
+            tag = match.group(1)
+            if tag is None:
+                continue
+            tag = tag.lower()
+
+            text = None
+            if tag in self.RE_RAW_TEXT_END:
+                end = self.RE_RAW_TEXT_END[tag].search(content, pos)
+                end_pos = len(content) if end is None else end.start()
+                text = content[pos:end_pos] or None
+                pos = len(content) if end is None else end.end()
+
+            if tag in self.tags:
+                self.elems.append(
+                    ParsedElem(tag, self.parse_attrs(match.group(2)), text)
+                )
+
+    def parse_attrs(self, attrs_str):
+        attrs = {}
+        for match in self.RE_ATTR.finditer(attrs_str):
+            name, value = match.group(1).lower(), None
+            for group in (2, 3, 4):
+                if match.group(group) is not None:
+                    value = unescape(match.group(group))
+                    break
+            attrs[name] = value
+        return attrs
+
+
+def new_hash(data=b""):
+    """the hash used to fingerprint files and content (for cache-busting, not
+    security) -- blake2b is quicker than md5, and callers truncate it."""
+    return hashlib.blake2b(data, digest_size=16)
+
+
+def hash_file(filename, chunk_size=65536):
+    """returns the hex digest of a file's content, streamed from disk rather
+    than read into memory in one go."""
+    with open(filename, "rb") as file_handle:
+        if hasattr(hashlib, "file_digest"):  # python >= 3.11
+            return hashlib.file_digest(file_handle, new_hash).hexdigest()
+
+        file_hash = new_hash()
+        for chunk in iter(lambda: file_handle.read(chunk_size), b""):
+            file_hash.update(chunk)
+        return file_hash.hexdigest()
+
+
+# digests of files already hashed, keyed by (path, mtime, size) so that
+#  any modification to a file invalidates its entry.
+_FILE_HASH_CACHE = {}
+
+# digests computed (rather than loaded) since pop_new_file_hashes last ran.
+_NEW_FILE_HASHES = {}
+
+
+def load_file_hashes(path):
+    """loads digests saved (by save_file_hashes) on a previous run into the
+    cache used by get_file_hash."""
+    try:
+        with open(path, encoding="utf8") as _fh:
+            saved = json.load(_fh)
+        if saved["hash"] != _hash_name():
+            return
+        for filename, mtime_ns, size, digest in saved["files"]:
+            _FILE_HASH_CACHE[(filename, mtime_ns, size)] = digest
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+
+def save_file_hashes(path):
+    """saves the digests cached by get_file_hash to path (only the latest
+    entry for each file is kept, and files which no longer exist are
+    dropped)."""
+    latest = {}
+    for (filename, mtime_ns, size), digest in list(_FILE_HASH_CACHE.items()):
+        if filename not in latest or mtime_ns > latest[filename][0]:
+            latest[filename] = (mtime_ns, size, digest)
+    latest = {
+        filename: entry
+        for filename, entry in latest.items()
+        if os.path.exists(filename)
+    }
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_atomically(
+        path,
+        json.dumps(
+            {
+                "hash": _hash_name(),
+                "files": [(filename,) + entry for filename, entry in latest.items()],
+            }
+        ),
+    )
+
+
+def pop_new_file_hashes():
+    """returns (and forgets) the digests computed by get_file_hash since the
+    last call (so that they can be passed back from worker processes)."""
+    hashes = _NEW_FILE_HASHES.copy()
+    for key in hashes:
+        del _NEW_FILE_HASHES[key]
+    return hashes
+
+
+def add_file_hashes(hashes):
+    """adds digests (e.g. from pop_new_file_hashes in another process) to the
+    cache used by get_file_hash."""
+    _FILE_HASH_CACHE.update(hashes)
+
+
+def _hash_name():
+    hash_ = new_hash()
+    return "{0}-{1}".format(hash_.name, hash_.digest_size)
 
 
 def get_file_hash(filename, length=None):
-    filename = os.path.realpath(filename)
-    hash_file = open(filename, "rb")
-    try:
-        content = hash_file.read()
-    finally:
-        hash_file.close()
+    stat = os.stat(filename)
+    key = (filename, stat.st_mtime_ns, stat.st_size)
+
+    digest = _FILE_HASH_CACHE.get(key)
+    if digest is None:
+        digest = _FILE_HASH_CACHE[key] = _NEW_FILE_HASHES[key] = hash_file(filename)
 
-    digest = hashlib.md5(content).hexdigest()
     if length:
         return digest[:length]
     return digest
 
 
 def get_content_hash(content, length=None):
-    digest = hashlib.md5(content.encode("utf8")).hexdigest()
+    digest = new_hash(content.encode("utf8")).hexdigest()
     if length:
         return digest[:length]
     return digest
 
 
 def extract_filename(url, base_url, base_root, referrer):
-    """ get the appropriate filename from a url reference in the source """
+    """get the appropriate filename from a url reference in the source (the
+    file isn't checked for existence)."""
     local_path = url
 
     # remove url fragment, if any
@@ -76,15 +226,16 @@ def extract_filename(url, base_url, base_root, referrer):
         local_path = os.path.join(os.path.dirname(referrer), local_path)
 
     # Re-build the local full path by adding root
-    filename = os.path.join(base_root, local_path.lstrip("/"))
-    return os.path.exists(filename) and filename
+    return os.path.normpath(os.path.join(base_root, local_path.lstrip("/")))
 
 
 def add_cache_tag(url, base_url, base_root, referrer=""):
     filename = extract_filename(url, base_url, base_root, referrer)
-    file_hash = None
-    if filename:
+    try:
+        # (the stat() done by get_file_hash doubles as the existence check)
         file_hash = get_file_hash(filename, 12)
+    except OSError:
+        file_hash = None
 
     if file_hash is None:
         # Couldn't extract an accessible filepath --
@@ -117,6 +268,40 @@ def add_cache_tag(url, base_url, base_root, referrer=""):
     return url
 
 
+# the pool of threads used by map_threaded (created on first use, and shared
+#  between calls, since starting threads for each page costs more than the
+#  handful of files read in them).
+THREAD_POOL_SIZE = 8
+_THREAD_POOL = None
+_THREAD_POOL_LOCK = threading.Lock()
+
+
+def get_thread_pool():
+    global _THREAD_POOL
+    with _THREAD_POOL_LOCK:
+        if _THREAD_POOL is None:
+            _THREAD_POOL = ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE)
+        return _THREAD_POOL
+
+
+def reset_thread_pool():
+    """forget the pool of threads (e.g. in a forked process, to which the
+    parent's threads aren't carried over)."""
+    global _THREAD_POOL, _THREAD_POOL_LOCK
+    _THREAD_POOL = None
+    _THREAD_POOL_LOCK = threading.Lock()
+
+
+def map_threaded(func, items):
+    """like map(), but runs func over the items in the pool of threads (the
+    results are returned as a list, in order)."""
+    items = list(items)
+    if len(items) < 2:
+        return [func(item) for item in items]
+
+    return list(get_thread_pool().map(func, items))
+
+
 def get_basename(url, base_url):
     if not url.startswith(base_url):
         raise Exception(
@@ -140,6 +325,99 @@ def get_cache_filepath(content, output_dir, ext):
     return os.path.join(output_dir, ".".join([get_content_hash(content, 12), ext]))
 
 
+def write_atomically(path, content):
+    """writes content (str or bytes) to path by way of a temporary file which
+    is then renamed into place, so that a partially written file is never
+    visible at path (e.g. if the process dies mid-write)."""
+    if isinstance(content, str):
+        content = content.encode("utf8")
+
+    tmp_path = "{0}.{1}.{2}.tmp".format(path, os.getpid(), threading.get_ident())
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        # (written straight to the descriptor, bypassing python's buffered io,
+        #  which for a single write of the whole content is just overhead).
+        try:
+            view = memoryview(content)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+# maps digests of unminified sources to the names of the files (in the assets
+#  dir) their minified output was written to, so that sources which have been
+#  minified before (by this or a previous run) needn't be minified again.
+_MINIFY_INDEX = {}
+
+# entries added since pop_new_minify_entries last ran.
+_NEW_MINIFY_ENTRIES = {}
+
+
+def load_minify_index(path):
+    """loads an index saved (by save_minify_index) on a previous run."""
+    try:
+        with open(path, encoding="utf8") as _fh:
+            _MINIFY_INDEX.update(json.load(_fh))
+    except (OSError, ValueError, TypeError):
+        pass
+
+
+def save_minify_index(path, assets_dir):
+    """saves the minify index to path (dropping entries for files which are
+    no longer in assets_dir)."""
+    index = {
+        key: filename
+        for key, filename in list(_MINIFY_INDEX.items())
+        if os.path.exists(os.path.join(assets_dir, filename))
+    }
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_atomically(path, json.dumps(index))
+
+
+def pop_new_minify_entries():
+    """returns (and forgets) the entries added to the minify index since the
+    last call (so that they can be passed back from worker processes)."""
+    entries = _NEW_MINIFY_ENTRIES.copy()
+    for key in entries:
+        del _NEW_MINIFY_ENTRIES[key]
+    return entries
+
+
+def add_minify_entries(entries):
+    """adds entries (e.g. from pop_new_minify_entries in another process) to
+    the minify index."""
+    _MINIFY_INDEX.update(entries)
+
+
+def write_minified(content, assets_dir, ext, minify):
+    """minifies content and writes it to a content-hashed file in assets_dir,
+    returning the path of that file.  Sources which have been minified before
+    are found in the minify index and not minified again."""
+    # (the minifier is part of the key, so that changing it takes effect)
+    key = ":".join((ext, getattr(minify, "__name__", ""), get_content_hash(content)))
+    filename = _MINIFY_INDEX.get(key)
+    if filename is not None:
+        outputpath = os.path.join(assets_dir, filename)
+        if os.path.exists(outputpath):
+            return outputpath
+
+    content = minify(content)
+    outputpath = get_cache_filepath(content, assets_dir, ext)
+    if not os.path.exists(outputpath):
+        write_atomically(outputpath, content)
+
+    _MINIFY_INDEX[key] = _NEW_MINIFY_ENTRIES[key] = os.path.basename(outputpath)
+    return outputpath
+
+
 ##########################################################
 # standard utility functions made available to templates.
 ##########################################################
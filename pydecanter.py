@@ -3,29 +3,56 @@
 import atexit
 import argparse
 import errno
+import itertools
 import logging
+import multiprocessing
 import os
 import re
 import shutil
 import sys
 from configparser import ConfigParser
+from functools import lru_cache, partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
 from wsgiref.handlers import SimpleHandler
 from wsgiref.simple_server import WSGIServer, make_server
 
 import bottle
-import markdown
-import slimit
-import rcssmin
+from mako.exceptions import TopLevelLookupException
 from mako.lookup import TemplateLookup
-from bs4 import BeautifulSoup, Comment
-from tidylib import tidy_document
+import lxml.etree
+import lxml.html
 from termcolor import colored
 from socketserver import ThreadingMixIn
 
+try:
+    from waitress.server import create_server
+except ImportError:
+    create_server = None
+
+try:
+    import minify_html
+except ImportError:
+    minify_html = None
+    from tidylib import tidy_document
+
 from lib.monitor import Monitor
 
-from lib.utils import add_cache_tag, get_file_hash
+from lib.utils import (
+    add_cache_tag,
+    add_file_hashes,
+    add_minify_entries,
+    extract_filename,
+    get_file_hash,
+    load_file_hashes,
+    load_minify_index,
+    pop_new_file_hashes,
+    pop_new_minify_entries,
+    reset_thread_pool,
+    save_file_hashes,
+    save_minify_index,
+    write_atomically,
+)
 
 
 DEFAULT_ARGS = {
@@ -41,9 +68,15 @@ DEFAULT_ARGS = {
 }
 
 
+# where file hashes and the minify index are kept between builds (relative to
+#  base_root -- .build is one of the PRIVATE_FILES, so they aren't published).
+HASH_CACHE = os.path.join(".build", "hashcache.json")
+MINIFY_INDEX = os.path.join(".build", "minify_index.json")
+
+
 # list of extensions that need to be hard-coded to specific mime-types
 #  (these are ones which are not properly detected by bottle).
-FORCE_MIMETYPES = ((".vtt", "text/vtt"),)
+FORCE_MIMETYPES = {".vtt": "text/vtt"}
 
 
 TIDY_OPTIONS = {
@@ -61,6 +94,16 @@ TIDY_OPTIONS = {
     "new-blocklevel-tags": "script, svg, path",
 }
 
+# regular expressions used to post-process htmltidy's output.
+RE_TIDY_COMMENT = re.compile(r"(?<!\s)<!--")
+RE_TIDY_EMPTY_SCRIPT = re.compile(r"(?m)^(\s+)(.*?)(<script[^>]*>)\n</script>")
+RE_TIDY_SCRIPT = re.compile(
+    r"(?m)^(\s+)(.*?)(<script[^>]*>)\n((?:[^\n]+\n)+)\s+</script>"
+)
+RE_TIDY_SINGLE_LINE_ELEMS = re.compile(
+    r"^(\s*<([a-z][a-z0-9]*)\b[^>]*>)\s*([^\n]*?)\s*</\2>", re.DOTALL | re.MULTILINE
+)
+
 
 class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
     pass
@@ -72,6 +115,10 @@ class PyDecanter(object):
     RE_CACHEBUSTER = re.compile(
         r"(.*)\.[0-9a-f]{12}\.(jpe?g|gif|png|svg|ttf|woff|woff2)"
     )
+    RE_DOCTYPE = re.compile(rb"\s*<!DOCTYPE", re.IGNORECASE)
+    RE_SVGFALLBACK = re.compile(
+        r"this.onerror=null;\s*this.src='([^\']+\.(?:png|gif|jpe?g))'"
+    )
     CACHE_TAG_EXCS = (
         "favicon",
         "apple-touch-icon",
@@ -79,6 +126,7 @@ class PyDecanter(object):
         "mstile",
         "safari-pinned-tab",
     )
+    RE_CACHE_TAG_EXCS = re.compile("|".join(map(re.escape, CACHE_TAG_EXCS)))
 
     # A tuple of regular expressions representing files which should not be
     #  output as part of the build process.
@@ -95,20 +143,41 @@ class PyDecanter(object):
 
     def __init__(self, args):
 
+        # the arguments are kept so that build_static's worker processes can
+        #  create their own instances.
+        self.args = args
+
         # the Bottle application
         self.app = bottle.Bottle()
 
         # the base root from which to serve files
-        #  (mako needs a string, not a Path() object).
-        self.base_root = str(args.base_root.resolve())
+        #  (mako needs a string, not a Path() object, but both are kept).
+        self._base_root_path = args.base_root.resolve()
+        self.base_root = str(self._base_root_path)
         self.base_url = re.sub(r"/+", "/", "/{0}/".format(args.base_url))
+        self.re_local_image = re.compile(
+            "^" + self.base_url + r"[^/].+\.(?:png|gif|jpe?g)$"
+        )
 
         self.assets_dir = args.assets_dir
 
+        # the built-in private file patterns are combined to be matched in one
+        #  go (any passed in are matched separately, since they might not
+        #  survive being combined -- e.g. if they use global inline flags or
+        #  numbered backreferences), and the results are cached.
+        self.re_private = re.compile(
+            "|".join("(?:{0})".format(_.pattern) for _ in self.PRIVATE_FILES)
+        )
+        self.private_patterns = ()
         if "private" in args:
-            self.PRIVATE_FILES = self.PRIVATE_FILES + tuple(
+            self.private_patterns = tuple(
                 re.compile(_) for _ in args.private.split(",")
             )
+            self.PRIVATE_FILES = self.PRIVATE_FILES + self.private_patterns
+        self.is_private = lru_cache(maxsize=8192)(self.is_private)
+
+        # (as suffixes, so that template paths can be checked with endswith)
+        self.template_suffixes = tuple("." + ext for ext in self.TEMPLATE_EXTS)
 
         # the TemplateLookup of Mako
         self.templates = TemplateLookup(
@@ -120,13 +189,14 @@ class PyDecanter(object):
                 "from lib.decorators import css, js",
             ],
             input_encoding="UTF8",
+            output_encoding="utf-8",
             collection_size=100,
             default_filters=["trim"],
         )
 
         self.context = {
             "base_url": self.base_url.rstrip("/"),
-            "base_root": Path(self.base_root),
+            "base_root": self._base_root_path,
             "assets_dir": self.assets_dir,
             "output_root": self.base_root,
             "compress": False,
@@ -146,33 +216,37 @@ class PyDecanter(object):
         if os.path.isfile(os.path.join(self.base_root, "404.html")):
             self.app.error(404)(lambda err: self.render("404.html"))
 
-        # prep the simple WSGI server (could use waitress here, but the extra
-        #  dependency is not really necessary for dev-only purposes).
-        self.server = make_server(args.host, args.port, self, ThreadingWSGIServer)
-
-        def restart(modified_path, base_dir=os.getcwd()):
-            """automatically restart the server if changes are made to python
-            files on this path."""
-            self.server.server_close()
-            self.server.shutdown()
-            logging.info("change detected to '%s' -- restarting server", modified_path)
-            args = sys.argv[:]
-            args.insert(0, sys.executable)
-            os.chdir(base_dir)
-            os.execv(sys.executable, args)
-
-        monitor = Monitor(interval=1.0)
-        if args.ini_file is not None:
-            monitor.track(str(Path(os.path.expanduser(args.ini_file)).resolve()))
-        monitor.on_modified = restart
-
     def is_private(self, path):
         """returns True if the path represents a file which should not be
         output as part of the static site, and False otherwise."""
-        for regex in self.PRIVATE_FILES:
-            if regex.match(path):
-                return True
-        return False
+        return self.re_private.match(path) is not None or any(
+            _.match(path) for _ in self.private_patterns
+        )
+
+    def is_template(self, path):
+        """returns True if the path represents a file to be rendered by Mako."""
+        return path.endswith(self.template_suffixes) and self.templates.has_template(
+            path
+        )
+
+    def walk_public(self, dirpath=""):
+        """yields the paths (relative to base_root) of the public files under
+        dirpath.  Directories which are private by the built-in patterns (i.e.
+        whose paths with a trailing slash match them, like .git/) are not
+        descended into; patterns passed in with --private are only tested
+        against the paths of files.  As with os.walk, symlinks to directories
+        are not followed.
+        """
+        with os.scandir(os.path.join(self.base_root, dirpath)) as entries:
+            for entry in entries:
+                path = dirpath + entry.name
+                if entry.is_dir():
+                    if not entry.is_symlink() and not self.re_private.match(
+                        path + "/"
+                    ):
+                        yield from self.walk_public(path + "/")
+                elif not self.is_private(path):
+                    yield path
 
     def render(self, path):
         if os.path.isdir(os.path.join(self.base_root, path)):
@@ -183,19 +257,30 @@ class PyDecanter(object):
                 403, "Direct access to {0} is forbidden".format(path)
             )
 
-        if path.split(".")[-1] in self.TEMPLATE_EXTS and self.templates.has_template(
-            path
-        ):
+        if self.is_template(path):
 
-            template = self.templates.get_template(path)
+            try:
+                template = self.templates.get_template(path)
+            except TopLevelLookupException:
+                # (removed since has_template found it)
+                return bottle.HTTPError(404, "File does not exist.")
             self.context.update({"path": path})
-            document = template.render_unicode(**self.context)
+            # (Mako renders straight to utf-8 encoded bytes).
+            document = template.render(**self.context)
+
+            # (the document is parsed just the once, and the tree is passed
+            #  through both the cache-tagging and the tidying).
+            if self.context["compress"] and document.strip():
+                root = lxml.html.document_fromstring(document.decode("utf-8"))
+                self.add_image_cache_tags(root)
 
-            if self.context["compress"]:
-                document = self.add_image_cache_tags(document)
-                document = self.tidy_html(document)
+                # (lxml supplies a default doctype if the document has none)
+                doctype = ""
+                if self.RE_DOCTYPE.match(document):
+                    doctype = root.getroottree().docinfo.doctype
+                document = self.tidy_html(root, doctype).encode("utf-8")
 
-            return document.encode("utf-8")
+            return document
 
         # if using the static filters whilst using the dev. server, we need to
         #  remove the hash from image assets (note that the build_static
@@ -207,77 +292,111 @@ class PyDecanter(object):
 
         # bottle does not detext some mimetypes correctly, so here we check for
         #  any that need to be hard-coded.
-        for ext, mimetype in FORCE_MIMETYPES:
-            if path.endswith(ext):
-                return bottle.static_file(path, root=self.base_root, mimetype=mimetype)
+        mimetype = FORCE_MIMETYPES.get(os.path.splitext(path)[1])
+        if mimetype is not None:
+            return bottle.static_file(path, root=self.base_root, mimetype=mimetype)
 
         return bottle.static_file(path, root=self.base_root)
 
     @staticmethod
-    def tidy_html(document):
+    def is_conditional_comment(node):
+        """returns True if the node is an IE conditional comment."""
+        return (node.tag is lxml.etree.Comment) and (node.text or "").startswith(
+            ("[if", "<![endif")
+        )
+
+    @classmethod
+    def tidy_html(cls, root, doctype=""):
+        """strips (non-conditional) comments from the parsed document, and
+        serializes it through minify-html (if installed, in which case the
+        document's own doctype is kept) or htmltidy (which always outputs an
+        html5 doctype)."""
 
         # pre-process to remove comments (htmltidy's option to do so will
         #  also strip IE conditional comments).
-        soup = BeautifulSoup(document, "lxml")
-        for cmt in soup.findAll(text=lambda text: isinstance(text, Comment)):
-            if not (cmt.startswith("[if") or cmt.startswith("<![endif")):
-                cmt.extract()
+        for cmt in list(root.iter(lxml.etree.Comment)):
+            if not cls.is_conditional_comment(cmt):
+                cmt.drop_tree()
+
+        # comments outside of the <html> element can't be dropped from the
+        #  tree, so only the conditional ones are carried over to the output.
+        document = "".join(
+            [
+                lxml.html.tostring(node, encoding="unicode")
+                for node in reversed(list(root.itersiblings(preceding=True)))
+                if cls.is_conditional_comment(node)
+            ]
+            + [lxml.html.tostring(root, encoding="unicode")]
+            + [
+                lxml.html.tostring(node, encoding="unicode")
+                for node in root.itersiblings()
+                if cls.is_conditional_comment(node)
+            ]
+        )
 
-        document, errors_ = tidy_document(str(soup), options=TIDY_OPTIONS)
+        # if available, minify-html does the formatting in a single (native)
+        #  pass; otherwise the document is tidied by htmltidy.
+        if minify_html is not None:
+            document = minify_html.minify(
+                document, minify_css=True, minify_js=True, keep_comments=True
+            )
+            return doctype + "\n" + document if doctype else document
+
+        document, errors_ = tidy_document(document, options=TIDY_OPTIONS)
 
         # clean-up some line-breaks associated with conditional comments
-        document = re.sub(r"(?<!\s)<!--", "\n<!--", document)
+        document = RE_TIDY_COMMENT.sub("\n<!--", document)
 
         # adjust some of the htmltidy indenting to my own taste :)
-        document = re.sub(
-            r"(?m)^(\s+)(.*?)(<script[^>]*>)\n</script>",
-            r"\1\2\n\1\3</script>",
-            document,
-        )
-        document = re.sub(
-            r"(?m)^(\s+)(.*?)(<script[^>]*>)\n((?:[^\n]+\n)+)\s+</script>",
-            r"\1\2\n\1\3\n\1\4\1</script>",
-            document,
-        )
-        re_single_line_elems = re.compile(
-            r"^(\s*<([a-z][a-z0-9]*)\b[^>]*>)\s*([^\n]*?)\s*</\2>",
-            re.DOTALL | re.MULTILINE,
-        )
-        document = re_single_line_elems.sub(r"\1\3</\2>", document)
+        document = RE_TIDY_EMPTY_SCRIPT.sub(r"\1\2\n\1\3</script>", document)
+        document = RE_TIDY_SCRIPT.sub(r"\1\2\n\1\3\n\1\4\1</script>", document)
+        document = RE_TIDY_SINGLE_LINE_ELEMS.sub(r"\1\3</\2>", document)
         return document
 
-    def add_image_cache_tags(self, document):
-
-        re_svgfallback = re.compile(
-            r"this.onerror=null;\s*this.src='([^\']+\.(?:png|gif|jpe?g))'"
-        )
-
-        soup = BeautifulSoup(document, "lxml")
-        for img in soup.findAll("img"):
-            if not any([exc in img["src"] for exc in self.CACHE_TAG_EXCS]):
-                img["src"] = add_cache_tag(
-                    img["src"], self.base_url, self.base_root, self.context["path"]
+    def add_image_cache_tags(self, root):
+        """adds cache tags to the (local) images referenced in the parsed
+        document (the tree is modified in place, and returned)."""
+
+        for img in root.iter("img"):
+            src = img.get("src")
+            if src is not None and not self.RE_CACHE_TAG_EXCS.search(src):
+                img.set(
+                    "src",
+                    tagged_url(
+                        src, self.base_url, self.base_root, self.context["path"]
+                    ),
                 )
             # also need to deal with attributes of the form:
             #   onerror="this.onerror=null; this.src='<fallback_image>'"
-            if "onerror" in img.attrs and re_svgfallback.match(img["onerror"]):
-                img["onerror"] = re_svgfallback.sub(
-                    lambda m: m.group(0).replace(
-                        m.group(1),
-                        add_cache_tag(m.group(1), self.base_url, self.base_root),
+            onerror = img.get("onerror")
+            if onerror is not None and self.RE_SVGFALLBACK.match(onerror):
+                img.set(
+                    "onerror",
+                    self.RE_SVGFALLBACK.sub(
+                        lambda m: m.group(0).replace(
+                            m.group(1),
+                            tagged_url(m.group(1), self.base_url, self.base_root),
+                        ),
+                        onerror,
                     ),
-                    img["onerror"],
                 )
 
         # deal with <a href="<cache-tagged image here>">
-        re_local_image = re.compile("^" + self.base_url + r"[^/].+\.(?:png|gif|jpe?g)$")
-        for anchor in soup.findAll("a", href=re_local_image):
-            if not any([exc in anchor["href"] for exc in self.CACHE_TAG_EXCS]):
-                anchor["href"] = add_cache_tag(
-                    anchor["href"], self.base_url, self.base_root, self.context["path"]
+        for anchor in root.iter("a"):
+            href = anchor.get("href")
+            if (
+                href is not None
+                and self.re_local_image.match(href)
+                and not self.RE_CACHE_TAG_EXCS.search(href)
+            ):
+                anchor.set(
+                    "href",
+                    tagged_url(
+                        href, self.base_url, self.base_root, self.context["path"]
+                    ),
                 )
 
-        return str(soup)
+        return root
 
     @staticmethod
     def create_cache_dir(cache_dir, cleanup=True):
@@ -286,14 +405,7 @@ class PyDecanter(object):
         there to begin with).
         """
 
-        if not os.path.isdir(cache_dir):
-            try:
-                os.makedirs(cache_dir)
-            except OSError as exc:  # Python >2.5
-                if exc.errno == errno.EEXIST:
-                    pass
-                else:
-                    raise
+        os.makedirs(cache_dir, exist_ok=True)
 
         def cleanup_func():
             """ Helper function to remove the temporary cache folder. """
@@ -315,17 +427,59 @@ class PyDecanter(object):
             self.assets_dir = os.path.join(self.base_root, self.assets_dir)
             self.create_cache_dir(self.assets_dir)
 
-        try:
-            logging.info(
-                "server running at http://%s%s",
-                "{}:{}".format(*self.server.server_address),
-                self.base_url,
+        # prep the WSGI server -- waitress (with its pool of threads), if it's
+        #  installed, and otherwise the simple (thread per request) server.
+        if create_server is not None:
+            self.server = create_server(
+                self,
+                host=args.host,
+                port=args.port,
+                threads=os.cpu_count() or 4,
+                connection_limit=512,
             )
-            self.server.serve_forever(poll_interval=0.5)
+            # (if the host resolves to more than one address, waitress returns
+            #  a server listening on each of them).
+            server_addresses = getattr(self.server, "effective_listen", None) or [
+                (self.server.effective_host, self.server.effective_port)
+            ]
+            serve_forever = self.server.run
+            close_server = self.server.close
+        else:
+            self.server = make_server(args.host, args.port, self, ThreadingWSGIServer)
+            server_addresses = [self.server.server_address]
+            # (the poll interval is how often the server checks for shutdown)
+            serve_forever = partial(self.server.serve_forever, poll_interval=0.5)
+
+            def close_server():
+                self.server.server_close()
+                self.server.shutdown()
+
+        def restart(modified_path, base_dir=os.getcwd()):
+            """automatically restart the server if changes are made to python
+            files on this path."""
+            close_server()
+            logging.info("change detected to '%s' -- restarting server", modified_path)
+            args = sys.argv[:]
+            args.insert(0, sys.executable)
+            os.chdir(base_dir)
+            os.execv(sys.executable, args)
+
+        monitor = Monitor(interval=1.0)
+        if args.ini_file is not None:
+            monitor.track(str(Path(os.path.expanduser(args.ini_file)).resolve()))
+        monitor.on_modified = restart
+
+        try:
+            for host, port in server_addresses:
+                logging.info(
+                    "server running at http://%s%s",
+                    ("[{}]:{}" if ":" in host else "{}:{}").format(host, port),
+                    self.base_url,
+                )
+            serve_forever()
         except KeyboardInterrupt:
             logging.info("Quitting Server!")
-            self.server.server_close()
-            self.server.shutdown()
+            close_server()
             raise SystemExit
 
     def get(self, path):
@@ -354,13 +508,20 @@ class PyDecanter(object):
         self.assets_dir = os.path.join(args.output_dir, self.assets_dir)
         self.create_cache_dir(self.assets_dir, False)
         self.context.update({"output_root": args.output_dir, "compress": args.compress})
-        public_files = []
-        for dirpath, dirnames_, filenames in os.walk(self.base_root):
-            for filename in filenames:
-                path = os.path.relpath(os.path.join(dirpath, filename), self.base_root)
-                if not self.is_private(path):
-                    public_files.append(path)
-
+        public_files = list(self.walk_public())
+
+        # file hashes from previous builds only need recomputing for files
+        #  which have been modified since.
+        #  (similarly, sources minified by previous builds are kept track of).
+        hash_cache = os.path.join(self.base_root, HASH_CACHE)
+        minify_index = os.path.join(self.base_root, MINIFY_INDEX)
+        if self.context["compress"]:
+            load_file_hashes(hash_cache)
+            load_minify_index(minify_index)
+
+        templates = []
+        copies = []
+        output_dirs = set()
         for filepath in public_files:
 
             # if filepath represents a cacheable asset, add a (hash) tag
@@ -368,7 +529,7 @@ class PyDecanter(object):
             if (
                 self.context["compress"]
                 and self.RE_CACHEBUSTABLE.match(filepath)
-                and not any(exc in filepath for exc in self.CACHE_TAG_EXCS)
+                and not self.RE_CACHE_TAG_EXCS.search(filepath)
             ):
 
                 filehash = get_file_hash(os.path.join(self.base_root, filepath), 12)
@@ -382,26 +543,205 @@ class PyDecanter(object):
             else:
                 output_path = os.path.join(args.output_dir, filepath)
 
+            # (each output directory only needs creating once).
             dirname = os.path.dirname(output_path)
-            if not os.path.exists(dirname):
-                os.makedirs(dirname)
+            if dirname not in output_dirs:
+                os.makedirs(dirname, exist_ok=True)
+                output_dirs.add(dirname)
 
-            if filepath.endswith((".html", ".css", ".js")):
+            if self.is_template(filepath):
+                templates.append((filepath, output_path))
+            else:
+                copies.append((filepath, output_path))
+
+        # templates are rendered (directly, rather than through the WSGI app)
+        #  in worker processes, since rendering is CPU-bound, and other files
+        #  are just copied, in threads.  The renders are submitted first so
+        #  that the worker processes are started before any copying threads.
+        #  (the worker processes are shared between builds, so each render is
+        #  passed the settings for the build along with its paths).
+        build = (next(_BUILD_IDS), self.args, self.context, self.assets_dir)
+        processes = worker_pool(len(templates))
+        renders = []
+        futures = []
+        with ThreadPoolExecutor() as threads:
+            for filepath, output_path in templates:
                 logging.info(colored("generating %s", "blue"), filepath)
-                content = self.get(filepath)
-
-                with open(output_path, "wb") as _fh:
-                    _fh.write(content)
+                renders.append(
+                    processes.submit(render_to_file, build, filepath, output_path)
+                )
+            futures.extend(renders)
 
-            else:
-                # just copy the file instead
+            for filepath, output_path in copies:
                 logging.info(colored("copying %s", "green"), filepath)
-                shutil.copy2(os.path.join(self.base_root, filepath), output_path)
+                futures.append(
+                    threads.submit(
+                        copy_if_modified,
+                        os.path.join(self.base_root, filepath),
+                        output_path,
+                    )
+                )
+
+            for future in as_completed(futures):
+                future.result()
+
+        # (the renders return the file hashes computed, and the sources
+        #  minified, in the workers).
+        if self.context["compress"]:
+            for future in renders:
+                file_hashes, minify_entries = future.result()
+                add_file_hashes(file_hashes)
+                add_minify_entries(minify_entries)
+            save_file_hashes(hash_cache)
+            save_minify_index(minify_index, self.assets_dir)
 
     def __call__(self, environ, start_response):
         return self.app(environ, start_response)
 
 
+def tagged_url(url, base_url, base_root, referrer=""):
+    """add_cache_tag, memoized (images are often referenced repeatedly, both
+    within a page and across the pages of a build) -- the file's modification
+    time and size are part of the key, so modified files are tagged afresh."""
+    try:
+        stat = os.stat(extract_filename(url, base_url, base_root, referrer))
+    except OSError:
+        return url
+    return _tagged_url(
+        url, base_url, base_root, referrer, stat.st_mtime_ns, stat.st_size
+    )
+
+
+@lru_cache(maxsize=4096)
+def _tagged_url(url, base_url, base_root, referrer, mtime_ns_, size_):
+    return add_cache_tag(url, base_url, base_root, referrer)
+
+
+def copy_file(src, dst):
+    """copy src to dst (along with its metadata) using copy_file_range where
+    possible -- an in-kernel copy which, on filesystems supporting reflinks,
+    needn't copy any data at all -- and otherwise shutil.copy2."""
+    if not hasattr(os, "copy_file_range"):  # python < 3.8, or not linux
+        return shutil.copy2(src, dst)
+
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+                pass
+    except OSError as exc:
+        # e.g. not supported by the kernel, or across these filesystems
+        if exc.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP):
+            raise
+        return shutil.copy2(src, dst)
+
+    shutil.copystat(src, dst)
+    return dst
+
+
+def copy_if_modified(src, dst):
+    """copy src to dst (along with its metadata), unless dst already has the
+    same size and modification time (i.e. was copied by a previous build)."""
+    src_stat = os.stat(src)
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        pass
+    else:
+        if (dst_stat.st_size, dst_stat.st_mtime_ns) == (
+            src_stat.st_size,
+            src_stat.st_mtime_ns,
+        ):
+            return dst
+
+    return copy_file(src, dst)
+
+
+# the pool of worker processes used (and reused) by build_static, and its
+#  number of workers.  Where possible the workers are forked, so that they
+#  start with the modules already imported by (and any state set up in) this
+#  process, rather than with a fresh interpreter.
+_WORKER_POOL = (None, 0)
+try:
+    WORKER_MP_CONTEXT = multiprocessing.get_context("fork")
+except ValueError:  # i.e. not available on this platform
+    WORKER_MP_CONTEXT = None
+
+# identifiers for each build, and the (id, PyDecanter instance) used for the
+#  current build in each of the worker processes.
+_BUILD_IDS = itertools.count()
+_build_decanter = (None, None)
+
+
+def warmup_worker():
+    """set up a worker process when it starts: import the modules which
+    templates need for rendering (but which are otherwise only imported
+    lazily, by Mako), and reset any state inherited from the parent."""
+    import lib.decorators  # noqa: F401
+    import lib.typogrify  # noqa: F401
+
+    # (any threads in the parent process aren't carried over to the worker)
+    reset_thread_pool()
+
+
+def worker_pool(max_workers):
+    """return the (shared) pool of worker processes, creating it (or, if it
+    has fewer than max_workers workers, replacing it) if needs be.  There
+    are never more workers than CPUs."""
+    global _WORKER_POOL
+    max_workers = max(1, min(os.cpu_count() or 1, max_workers))
+    pool, pool_size = _WORKER_POOL
+    if pool is None or pool_size < max_workers:
+        if pool is not None:
+            pool.shutdown()
+        pool = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=WORKER_MP_CONTEXT,
+            initializer=warmup_worker,
+        )
+        _WORKER_POOL = (pool, max_workers)
+    return pool
+
+
+def get_build_decanter(build):
+    """return the PyDecanter instance for the given build (in a build_static
+    worker process), setting one up if it's the first render of the build."""
+    global _build_decanter
+    build_id, args, context, assets_dir = build
+    if _build_decanter[0] != build_id:
+        decanter = PyDecanter(args)
+        if context["compress"]:
+            load_file_hashes(os.path.join(decanter.base_root, HASH_CACHE))
+            load_minify_index(os.path.join(decanter.base_root, MINIFY_INDEX))
+        decanter.context.update(context)
+        decanter.assets_dir = assets_dir
+        _build_decanter = (build_id, decanter)
+    return _build_decanter[1]
+
+
+def render_to_file(build, filepath, output_path):
+    """render a template to output_path (in a build_static worker), returning
+    any file hashes computed, and minify index entries added, along the way."""
+    content = get_build_decanter(build).render(filepath)
+
+    # (e.g. if the template has been removed since the build started)
+    if isinstance(content, bottle.HTTPResponse):
+        logging.warning("skipping %s (%s)", filepath, content.status_line)
+        return pop_new_file_hashes(), pop_new_minify_entries()
+
+    # leave the output file untouched if it's unchanged since a previous build
+    try:
+        unchanged = os.path.getsize(output_path) == len(content)
+        if unchanged:
+            with open(output_path, "rb") as _fh:
+                unchanged = _fh.read() == content
+    except OSError:
+        unchanged = False
+
+    if not unchanged:
+        write_atomically(output_path, content)
+    return pop_new_file_hashes(), pop_new_minify_entries()
+
+
 def get_config_from_ini_file(args):
 
     cfg = ConfigParser()
@@ -0,0 +1,29 @@
+from lib.css_compressor import CssAbsoluteFilter
+from lib.utils import get_file_hash
+
+
+def test_filter_rewrites_relative_urls(tmp_path):
+    (tmp_path / "img").mkdir()
+    (tmp_path / "img" / "a.png").write_bytes(b"png")
+    css_filter = CssAbsoluteFilter(str(tmp_path), "/")
+
+    content = css_filter.process(
+        "a { background: url(../img/a.png) } b { background: url(missing.png) }",
+        "/css/main.css",
+        "/css/main.css",
+    )
+
+    file_hash = get_file_hash(str(tmp_path / "img" / "a.png"), 12)
+    assert "url('/img/a.{0}.png')".format(file_hash) in content
+    assert "url('/css/missing.png')" in content
+
+
+def test_filter_skips_absolute_and_data_urls():
+    css_filter = CssAbsoluteFilter("/nonexistent", "/")
+    content = (
+        'a { background: url("data:image/png;base64,AAAA") }'
+        " b { background: url(https://example.com/b.png) }"
+        " c { background: url(#fragment) }"
+    )
+
+    assert css_filter.process(content, "/main.css", "/main.css") == content
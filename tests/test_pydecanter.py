@@ -1,9 +1,13 @@
+import json
+import os
 from pathlib import Path
 from argparse import Namespace
 
 import pytest
 
+import pydecanter
 from pydecanter import PyDecanter, DEFAULT_ARGS
+from lib.utils import get_file_hash
 
 
 @pytest.fixture(scope="session")
@@ -17,6 +21,28 @@ def decanter(base_root):
     return PyDecanter(args)
 
 
+@pytest.fixture
+def compress(monkeypatch):
+    """stubs out htmltidy (which needs libtidy) for compressed renders."""
+    monkeypatch.setattr(pydecanter, "minify_html", None)
+    monkeypatch.setattr(
+        pydecanter, "tidy_document", lambda doc, options: (doc, ""), raising=False
+    )
+
+
+@pytest.fixture
+def build_workers(compress, monkeypatch):
+    """provides a fresh pool of build workers (forked with the stubs in place,
+    so that they're carried over)."""
+    if pydecanter.WORKER_MP_CONTEXT is None:
+        pytest.skip("build workers can't be forked on this platform")
+    monkeypatch.setattr(pydecanter, "_WORKER_POOL", (None, 0))
+    yield
+    pool = pydecanter._WORKER_POOL[0]
+    if pool is not None:
+        pool.shutdown()
+
+
 def test_index_get(decanter, base_root):
     index = base_root / "index.html"
     with index.open("w") as _fh:
@@ -33,3 +59,244 @@ def test_subdir_get(decanter, base_root):
         _fh.write("<h1>hello world!</h1>")
 
     assert decanter.get("/sub/hello.html") == b"<h1>hello world!</h1>"
+
+
+def test_subdir_index_render(decanter, base_root):
+    # (requested before the directory exists)
+    assert decanter.render("section").status_code == 404
+
+    subdir = base_root / "section"
+    subdir.mkdir()
+    index = subdir / "index.html"
+    with index.open("w") as _fh:
+        _fh.write("<h1>section</h1>")
+
+    assert decanter.render("section") == b"<h1>section</h1>"
+    assert decanter.render("section") == b"<h1>section</h1>"
+
+
+def test_unencodable_render(tmp_path):
+    # (output which can't be encoded is an error, rather than being replaced)
+    (tmp_path / "bad.html").write_text('${ "\\udcff" }')
+    args = Namespace(**{**DEFAULT_ARGS, **{"base_root": tmp_path, "ini_file": None}})
+    with pytest.raises(UnicodeEncodeError):
+        PyDecanter(args).render("bad.html")
+
+
+def test_removed_template_render(tmp_path):
+    args = Namespace(**{**DEFAULT_ARGS, **{"base_root": tmp_path, "ini_file": None}})
+    decanter = PyDecanter(args)
+    (tmp_path / "gone.html").write_text("<h1>here</h1>")
+    assert decanter.render("gone.html") == b"<h1>here</h1>"
+
+    (tmp_path / "gone.html").unlink()
+    assert decanter.render("gone.html").status_code == 404
+
+
+def test_private_patterns(tmp_path):
+    args = Namespace(
+        **{
+            **DEFAULT_ARGS,
+            **{"base_root": tmp_path, "ini_file": None, "private": r"(?i).*\.psd$"},
+        }
+    )
+    decanter = PyDecanter(args)
+
+    assert decanter.is_private("art/logo.PSD")
+    assert decanter.is_private("base.mako")
+    assert not decanter.is_private("art/logo.png")
+
+
+def test_walk_public(tmp_path):
+    for path in ("index.html", "docs/draft.html", "docs/public/a.html", ".git/HEAD"):
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text("")
+    args = Namespace(
+        **{
+            **DEFAULT_ARGS,
+            **{"base_root": tmp_path, "ini_file": None, "private": "^docs/(?!public)"},
+        }
+    )
+    decanter = PyDecanter(args)
+
+    assert sorted(decanter.walk_public()) == ["docs/public/a.html", "index.html"]
+
+
+def test_build_static(tmp_path):
+    root = tmp_path / "root"
+    (root / "css").mkdir(parents=True)
+    (root / "index.html").write_text("<h1>${ 'hello'.upper() }</h1>")
+    (root / "css" / "main.css").write_text("h1 { color: red }")
+    (root / "base.mako").write_text("private")
+
+    args = Namespace(
+        **{**DEFAULT_ARGS, **{"base_root": root, "ini_file": None, "port": 0}}
+    )
+    decanter = PyDecanter(args)
+    output_dir = tmp_path / "output"
+    decanter.build_static(
+        Namespace(output_dir=str(output_dir), context={}, compress=False)
+    )
+
+    assert (output_dir / "index.html").read_text() == "<h1>HELLO</h1>"
+    assert (output_dir / "css" / "main.css").read_text() == "h1 { color: red }"
+    assert not (output_dir / "base.mako").exists()
+
+    # a second build reuses the worker processes, but not their state.
+    (root / "index.html").write_text("<h1>${ 'again'.upper() }</h1>")
+    decanter = PyDecanter(args)
+    decanter.build_static(
+        Namespace(output_dir=str(output_dir), context={}, compress=False)
+    )
+    assert (output_dir / "index.html").read_text() == "<h1>AGAIN</h1>"
+
+
+def test_render_to_file_skips_errors(tmp_path):
+    args = Namespace(**{**DEFAULT_ARGS, **{"base_root": tmp_path, "ini_file": None}})
+    decanter = PyDecanter(args)
+    build = (next(pydecanter._BUILD_IDS), args, decanter.context, decanter.assets_dir)
+
+    output_path = tmp_path / "output.html"
+    pydecanter.render_to_file(build, "gone.html", str(output_path))
+    assert not output_path.exists()
+
+
+def test_worker_pool(build_workers):
+    pool = pydecanter.worker_pool(1)
+    assert pydecanter._WORKER_POOL == (pool, 1)
+
+    # (the pool is reused, unless more workers are wanted)
+    assert pydecanter.worker_pool(1) is pool
+    if (os.cpu_count() or 1) > 1:
+        assert pydecanter.worker_pool(2) is not pool
+        assert pydecanter._WORKER_POOL[1] == 2
+
+
+def test_build_static_hash_cache(tmp_path, build_workers):
+    root = tmp_path / "root"
+    (root / "img").mkdir(parents=True)
+    (root / "img" / "a.png").write_bytes(b"png")
+    (root / "index.html").write_text('<img src="/img/a.png">')
+
+    args = Namespace(
+        **{**DEFAULT_ARGS, **{"base_root": root, "ini_file": None, "port": 0}}
+    )
+    decanter = PyDecanter(args)
+    decanter.build_static(
+        Namespace(output_dir=str(tmp_path / "output"), context={}, compress=True)
+    )
+
+    # the hashes are kept with the site (but not published).
+    with open(str(root / pydecanter.HASH_CACHE)) as _fh:
+        assert str(root / "img" / "a.png") in _fh.read()
+    assert not (tmp_path / "output" / ".build").exists()
+
+
+def test_compressed_render(tmp_path, compress):
+    (tmp_path / "img").mkdir()
+    (tmp_path / "img" / "a.png").write_bytes(b"png")
+    (tmp_path / "index.html").write_text(
+        "<!DOCTYPE html>\n"
+        '<!--[if lt IE 9]><html class="ie"><![endif]-->\n'
+        "<html><body><!-- note --><p>text</p>"
+        '<img src="/img/a.png"><a href="/img/a.png">a</a>'
+        "<!--[if IE]><p>ie</p><![endif]--></body></html>"
+    )
+    args = Namespace(**{**DEFAULT_ARGS, **{"base_root": tmp_path, "ini_file": None}})
+    decanter = PyDecanter(args)
+    decanter.context["compress"] = True
+
+    document = decanter.render("index.html").decode("utf-8")
+    tagged = "/img/a.{0}.png".format(
+        get_file_hash(str(tmp_path / "img" / "a.png"), 12)
+    )
+
+    assert "note" not in document
+    assert '<!--[if lt IE 9]><html class="ie"><![endif]-->' in document
+    assert "<!--[if IE]><p>ie</p><![endif]-->" in document
+    assert '<img src="{0}">'.format(tagged) in document
+    assert '<a href="{0}">a</a>'.format(tagged) in document
+
+
+    # (a modified image is tagged afresh by the next render)
+    (tmp_path / "img" / "a.png").write_bytes(b"changed")
+    document = decanter.render("index.html").decode("utf-8")
+    assert "/img/a.{0}.png".format(
+        get_file_hash(str(tmp_path / "img" / "a.png"), 12)
+    ) in document
+
+
+def test_build_static_minify_index(tmp_path, build_workers):
+    root = tmp_path / "root"
+    (root / "css").mkdir(parents=True)
+    (root / "css" / "main.css").write_text("h1 { color: red }")
+    (root / "index.html").write_text(
+        '<%def name="styles()" decorator="css">'
+        '<link rel="stylesheet" href="/css/main.css"></%def><% styles() %>'
+    )
+
+    args = Namespace(
+        **{**DEFAULT_ARGS, **{"base_root": root, "ini_file": None, "port": 0}}
+    )
+    output_dir = tmp_path / "output"
+    PyDecanter(args).build_static(
+        Namespace(output_dir=str(output_dir), context={}, compress=True)
+    )
+
+    # the index (of the sources minified in the workers) is kept with the
+    #  site, rather than being published with it.
+    (minified,) = (output_dir / "assets").iterdir()
+    assert minified.read_text() == "h1{color:red}"
+    with open(str(root / pydecanter.MINIFY_INDEX)) as _fh:
+        assert list(json.load(_fh).values()) == [minified.name]
+
+
+def test_build_static_compressed_twice(tmp_path, build_workers):
+    root = tmp_path / "root"
+    (root / "img").mkdir(parents=True)
+    (root / "img" / "a.png").write_bytes(b"png")
+    (root / "index.html").write_text('<img src="/img/a.png"><img src="/img/new.png">')
+
+    args = Namespace(
+        **{**DEFAULT_ARGS, **{"base_root": root, "ini_file": None, "port": 0}}
+    )
+    output_dir = tmp_path / "output"
+    PyDecanter(args).build_static(
+        Namespace(output_dir=str(output_dir), context={}, compress=True)
+    )
+
+    # the worker processes are reused by the second build, but any images
+    #  modified (or added) since the first are tagged afresh.
+    (root / "img" / "a.png").write_bytes(b"changed")
+    (root / "img" / "new.png").write_bytes(b"new")
+    PyDecanter(args).build_static(
+        Namespace(output_dir=str(output_dir), context={}, compress=True)
+    )
+
+    document = (output_dir / "index.html").read_text()
+    for name in ("a", "new"):
+        file_hash = get_file_hash(str(root / "img" / "{0}.png".format(name)), 12)
+        assert "/img/{0}.{1}.png".format(name, file_hash) in document
+        assert (output_dir / "img" / "{0}.{1}.png".format(name, file_hash)).exists()
+
+
+def test_compressed_render_minify_html(tmp_path):
+    pytest.importorskip("minify_html")
+    (tmp_path / "index.html").write_text(
+        '<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01//EN">\n'
+        "<html><body><!-- note --><p>some   text</p>"
+        "<!--[if IE]><p>ie</p><![endif]--></body></html>"
+    )
+    (tmp_path / "fragment.html").write_text("<p>fragment</p>")
+    args = Namespace(**{**DEFAULT_ARGS, **{"base_root": tmp_path, "ini_file": None}})
+    decanter = PyDecanter(args)
+    decanter.context["compress"] = True
+
+    document = decanter.render("index.html").decode("utf-8")
+    assert document.startswith('<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01//EN">\n')
+    assert "note" not in document
+    assert "<p>some text" in document
+    assert "<!--[if IE]><p>ie</p><![endif]-->" in document
+
+    # (no doctype is added to templates which don't have one)
+    assert "doctype" not in decanter.render("fragment.html").decode("utf-8").lower()
@@ -0,0 +1,99 @@
+import os
+
+from lib import utils
+from lib.utils import (
+    PyDecanterParser,
+    add_cache_tag,
+    get_file_hash,
+    load_file_hashes,
+    save_file_hashes,
+    write_minified,
+)
+
+
+def test_file_hash_changes_with_content(tmp_path):
+    asset = tmp_path / "image.png"
+    asset.write_bytes(b"first")
+    first = get_file_hash(str(asset), 12)
+
+    assert len(first) == 12
+    assert get_file_hash(str(asset), 12) == first
+
+    asset.write_bytes(b"second")
+    stat = asset.stat()
+    os.utime(str(asset), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+    assert get_file_hash(str(asset), 12) != first
+
+
+def test_parser_extracts_tags():
+    block = """<link rel="stylesheet" href="/main.css?a=1&amp;b=2" media=print>
+<!--[if lt IE 9]><script src="/ie.js"></script><![endif]-->
+<STYLE type='text/css'>a > b { color: red }</style>
+<script>if (a < b) { "<link>"; }</script>"""
+
+    elems = PyDecanterParser(block, ["style", "link"]).elems
+
+    assert [elem.tag for elem in elems] == ["link", "style"]
+    assert elems[0].attrs_dict == {
+        "rel": "stylesheet",
+        "href": "/main.css?a=1&b=2",
+        "media": "print",
+    }
+    assert elems[1].text == "a > b { color: red }"
+
+
+def test_write_minified_skips_known_sources(tmp_path):
+    calls = []
+
+    def minify(content):
+        calls.append(content)
+        return content.replace(" ", "")
+
+    first = write_minified("a { b: c }", str(tmp_path), "css", minify)
+    second = write_minified("a { b: c }", str(tmp_path), "css", minify)
+
+    assert first == second
+    assert open(first).read() == "a{b:c}"
+    assert len(calls) == 1
+
+
+def test_add_cache_tag(tmp_path):
+    (tmp_path / "img").mkdir()
+    (tmp_path / "img" / "a.png").write_bytes(b"png")
+    file_hash = get_file_hash(str(tmp_path / "img" / "a.png"), 12)
+
+    assert add_cache_tag("/img/a.png?v=1", "/", str(tmp_path)) == (
+        "/img/a.{0}.png?v=1".format(file_hash)
+    )
+    assert add_cache_tag("/img/missing.png", "/", str(tmp_path)) == (
+        "/img/missing.png"
+    )
+
+    # files added later are picked up
+    (tmp_path / "img" / "missing.png").write_bytes(b"png")
+    assert add_cache_tag("/img/missing.png", "/", str(tmp_path)) == (
+        "/img/missing.{0}.png".format(file_hash)
+    )
+
+
+def test_file_hashes_persist(tmp_path, monkeypatch):
+    asset = tmp_path / "image.png"
+    asset.write_bytes(b"image")
+    file_hash = get_file_hash(str(asset))
+    removed = tmp_path / "removed.png"
+    removed.write_bytes(b"removed")
+    get_file_hash(str(removed))
+    removed.unlink()
+    hash_cache = str(tmp_path / ".build" / "hashcache.json")
+    save_file_hashes(hash_cache)
+
+    # (files which no longer exist aren't saved)
+    with open(hash_cache) as _fh:
+        assert str(removed) not in _fh.read()
+
+    monkeypatch.setattr(utils, "_FILE_HASH_CACHE", {})
+    monkeypatch.setattr(utils, "hash_file", None)  # i.e. must not be called
+    load_file_hashes(hash_cache)
+
+    assert get_file_hash(str(asset)) == file_hash